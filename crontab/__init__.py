@@ -1,4 +1,12 @@
+from ._crontab import (CronTab, next_many, clear_date_tables,
+    set_date_tables_maxsize)
+from ._cache import ResultCache
+from ._simulate import Simulator, VirtualClock
+from ._shard import HashRing, LocalMembership, ShardedScheduler
+from ._store import (LogFireStore, SQLiteFireStore, MISSED_ALL, MISSED_ONCE,
+    MISSED_SKIP)
 
-from ._crontab import CronTab
-
-__all__ = ['CronTab']
+__all__ = ['CronTab', 'next_many', 'clear_date_tables',
+    'set_date_tables_maxsize', 'HashRing', 'LocalMembership',
+    'ShardedScheduler', 'LogFireStore', 'SQLiteFireStore', 'MISSED_ALL',
+    'MISSED_ONCE', 'MISSED_SKIP', 'Simulator', 'VirtualClock', 'ResultCache']
@@ -0,0 +1,87 @@
+
+'''
+_cache.py
+
+A shared cache of next_ts() / prev_ts() results, for when many entries with
+the same schedule are asked about the same (or nearby) times.
+
+Copyright 2011-2025 Josiah Carlson
+Released under the GNU LGPL v2.1 and v3
+'''
+
+from collections import OrderedDict
+import threading
+
+
+class ResultCache(object):
+    __slots__ = 'maxsize', 'intervals', 'hits', 'misses', '_cache', '_lock'
+    def __init__(self, maxsize=1024, intervals=4):
+        """
+        input:
+            `maxsize` - the number of (schedule, direction) pairs to keep
+                        results for, least recently used are dropped first
+            `intervals` - the number of results to keep for each pair
+        """
+        self.maxsize = maxsize
+        self.intervals = intervals
+        self.hits = self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def next_ts(self, crontab, ts, date_table=False):
+        '''
+        Same as `crontab.next_ts(ts, date_table)`, but shares results between
+        entries with the same schedule. A result `r` for a query at `q` also
+        answers any query in [q, r), as nothing fires in between.
+        '''
+        key = (crontab._schedule_key(), True)
+        floor = int(ts // 1)
+        found, result = self._get(key, floor)
+        if not found:
+            result = crontab.next_ts(floor, date_table)
+            self._put(key, (floor, result, result))
+        return result
+
+    def prev_ts(self, crontab, ts, date_table=False):
+        '''
+        Same as `crontab.prev_ts(ts, date_table)`, but shares results between
+        entries with the same schedule. A result `r` for a query at `q` also
+        answers any query in (r, q].
+        '''
+        key = (crontab._schedule_key(), False)
+        ceil = -int(-ts // 1)
+        found, result = self._get(key, ceil)
+        if not found:
+            result = crontab.prev_ts(ceil, date_table)
+            # stored as a [lo, hi) range over ceil(ts)
+            self._put(key, (None if result is None else result + 1, ceil + 1, result))
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def _get(self, key, ts):
+        with self._lock:
+            ranges = self._cache.pop(key, None)
+            if ranges is None:
+                self.misses += 1
+                return False, None
+            # re-insert as most recently used
+            self._cache[key] = ranges
+            for lo, hi, result in ranges:
+                if (lo is None or lo <= ts) and (hi is None or ts < hi):
+                    self.hits += 1
+                    return True, result
+            self.misses += 1
+            return False, None
+
+    def _put(self, key, item):
+        with self._lock:
+            ranges = self._cache.pop(key, None) or []
+            ranges.insert(0, item)
+            del ranges[self.intervals:]
+            self._cache[key] = ranges
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
@@ -13,10 +13,14 @@ Other licenses may be available upon request.
 
 '''
 
-from collections import namedtuple
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
 from datetime import datetime, timedelta
+import os
 import random
 import sys
+import threading
 import warnings
 
 _ranges = [
@@ -69,9 +73,11 @@ ability. There are tests...'''
 
 if sys.version_info >= (3, 0):
     _number_types = (int, float)
+    _string_types = str
     xrange = range
 else:
     _number_types = (int, long, float)
+    _string_types = basestring
 
 SECOND = timedelta(seconds=1)
 MINUTE = timedelta(minutes=1)
@@ -82,14 +88,125 @@ MONTH = timedelta(days=28)
 YEAR = timedelta(days=365)
 
 WARN_CHANGE = object()
+# the FutureWarning above is only issued once per process, so next() doesn't
+# hit the (shared, mutable) warnings machinery on every call; the first call
+# sets this even if the warning is being filtered out at the time
+_warned_change = False
+
+# integer civil calendar helpers, used by the *_ts() methods to avoid datetime
+# objects entirely; see http://howardhinnant.github.io/date_algorithms.html
+_month_days = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def _days_in_month(y, m):
+    if m == 2 and y % 4 == 0 and (y % 100 != 0 or y % 400 == 0):
+        return 29
+    return _month_days[m]
+
+def _days_from_civil(y, m, d):
+    # days since 1970-01-01
+    if m <= 2:
+        y -= 1
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m - 3 if m > 2 else m + 9) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def _civil_from_days(z):
+    # inverse of the above, returns (year, month, day)
+    z += 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (m <= 2), m, d
+
+def _weekday_from_days(z):
+    # 1970-01-01 was a Thursday, Sunday is 0
+    return (z + 4) % 7
+
+# (day, month, weekday inputs, year) -> sorted array of matching day numbers,
+# shared by all CronTab objects with the same date fields; least recently used
+# tables are dropped past _date_tables_maxsize. Tables are built outside the
+# lock, so threads racing to build one just duplicate work.
+_date_tables = OrderedDict()
+_date_tables_lock = threading.Lock()
+_date_tables_maxsize = 4096
+
+def clear_date_tables():
+    '''
+    Drops all of the cached date tables used by `CronTab.next_ts(...,
+    date_table=True)`, `CronTab.prev_ts(..., date_table=True)`, and
+    `CronTab.count_ts()`.
+    '''
+    with _date_tables_lock:
+        _date_tables.clear()
+
+def set_date_tables_maxsize(maxsize):
+    '''
+    Sets how many per-year date tables are cached (4096 by default), dropping
+    the least recently used ones past that. Each table is at most 366 day
+    numbers.
+    '''
+    global _date_tables_maxsize
+    _assert(maxsize >= 0, "maxsize must be non-negative, you provided %r", maxsize)
+    with _date_tables_lock:
+        _date_tables_maxsize = maxsize
+        while len(_date_tables) > maxsize:
+            _date_tables.popitem(last=False)
+
+def _build_date_table(matchers, y):
+    days = array('l')
+    for mo in matchers.month.ordered:
+        eom = _days_in_month(y, mo)
+        first = _days_from_civil(y, mo, 1)
+        for d in xrange(1, eom+1):
+            wd = _weekday_from_days(first + d - 1)
+            if matchers.day.match(d, d, eom, wd) and matchers.weekday.match(wd, d, eom, wd):
+                days.append(first + d - 1)
+    return days
+
+def _special_days(item, first, eom):
+    '''
+    Returns the days of the month matched by an L, Lx, Zx, W, or # item, for
+    a month with `eom` days whose 1st falls on weekday `first`.
+    '''
+    wday = lambda d: (first + d - 1) % 7
+    if item == 'l':
+        return [eom]
+    if item == 'lw':
+        d = eom
+        while wday(d) in (0, 6):
+            d -= 1
+        return [d]
+    if item.endswith('w'):
+        # Quartz-style: the nearest Monday-Friday, without leaving the month
+        d = int(item[:-1], 10)
+        if d > eom:
+            return []
+        if wday(d) == 6:
+            d = d - 1 if d > 1 else d + 2
+        elif wday(d) == 0:
+            d = d + 1 if d < eom else d - 2
+        return [d]
+    if '#' in item:
+        x, _, n = item.partition('#')
+        x = _alternate[WEEK_OFFSET][x] if x in _alternate[WEEK_OFFSET] else int(x, 10) % 7
+        d = 1 + (x - first) % 7 + 7 * (int(n, 10) - 1)
+        return [d] if d <= eom else []
+
+    start, _, end = item[1:].partition('-')
+    values = range(int(start, 10), int(end or start, 10) + 1)
+    if item.startswith('z'):
+        return [eom - i for i in values]
+    # the last given weekday(s) of the month
+    values = set(v % 7 for v in values)
+    return [d for d in xrange(eom - 6, eom + 1) if wday(d) in values]
 
 # find the next scheduled time
-def _end_of_month(dt):
-    ndt = dt + DAY
-    while dt.month == ndt.month:
-        ndt += DAY
-    return ndt.replace(day=1) - DAY
-
 def _month_incr(dt, m):
     odt = dt
     dt += MONTH
@@ -108,31 +225,36 @@ def _year_incr(dt, m):
         return YEAR + DAY
     return YEAR
 
+def _day_jump(dt, matcher, step):
+    # straight to the next (or previous) day in the month that the day of
+    # month or day of week matcher matches, else to the first day of the next
+    # month (or the last day of the previous month)
+    day = dt.day
+    eom = _days_in_month(dt.year, dt.month)
+    d = matcher.next_day(day, eom, (dt.isoweekday() - day + 1) % 7, step)
+    if d is None:
+        d = eom + 1 if step > 0 else 0
+    return (d - day) * DAY
+
 _increments = [
     lambda *a: SECOND,
     lambda *a: MINUTE,
     lambda *a: HOUR,
-    lambda *a: DAY,
+    lambda dt,m: _day_jump(dt, m.day, 1),
     _month_incr,
-    lambda *a: DAY,
+    lambda dt,m: _day_jump(dt, m.weekday, 1),
     _year_incr,
     lambda dt,x: dt.replace(second=0),
     lambda dt,x: dt.replace(minute=0),
     lambda dt,x: dt.replace(hour=0),
-    lambda dt,x: dt.replace(day=1) if x > DAY else dt,
-    lambda dt,x: dt.replace(month=1) if x > DAY else dt,
+    # day jumps can move more than one day, only a year increment resets the
+    # day and month (the month increment already lands on the 1st)
+    lambda dt,x: dt.replace(day=1) if x >= YEAR else dt,
+    lambda dt,x: dt.replace(month=1) if x >= YEAR else dt,
     lambda dt,x: dt,
 ]
 
 # find the previously scheduled time
-def _day_decr(dt, m):
-    if m.day.input != 'l':
-        return -DAY
-    odt = dt
-    ndt = dt = dt - DAY
-    while dt.month == ndt.month:
-        dt -= DAY
-    return dt - odt
 
 def _month_decr(dt, m):
     odt = dt
@@ -150,7 +272,8 @@ def _year_decr(dt, m):
     return -YEAR
 
 def _day_decr_reset(dt, x):
-    if x >= -DAY:
+    # the month decrement already lands on the last day of the month
+    if x > -YEAR:
         return dt
     cur = dt.month
     while dt.month == cur:
@@ -161,15 +284,16 @@ _decrements = [
     lambda *a: -SECOND,
     lambda *a: -MINUTE,
     lambda *a: -HOUR,
-    _day_decr,
+    lambda dt,m: _day_jump(dt, m.day, -1),
     _month_decr,
-    lambda *a: -DAY,
+    lambda dt,m: _day_jump(dt, m.weekday, -1),
     _year_decr,
     lambda dt,x: dt.replace(second=59),
     lambda dt,x: dt.replace(minute=59),
     lambda dt,x: dt.replace(hour=23),
     _day_decr_reset,
-    lambda dt,x: dt.replace(month=12) if x < -DAY else dt,
+    # the day was moved to the end of the old month above, Dec has 31 days
+    lambda dt,x: dt.replace(month=12, day=31) if x <= -YEAR else dt,
     lambda dt,x: dt,
     _year_decr,
 ]
@@ -180,8 +304,24 @@ def _assert(condition, message, *args):
     if not condition:
         raise ValueError(message%args)
 
+_set = object.__setattr__
+
+def _immutable(self, name, value):
+    raise AttributeError("%s objects are immutable" % type(self).__name__)
+
+# pickle support for the immutable __slots__ classes
+def _getstate(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+def _setstate(self, state):
+    if isinstance(state, tuple):
+        # pickled before these classes were immutable: (None, slot_state)
+        state = state[1]
+    for name, value in state.items():
+        _set(self, name, value)
+
 class _Matcher(object):
-    __slots__ = 'allowed', 'end', 'any', 'input', 'which', 'split', 'loop'
+    __slots__ = 'allowed', 'end', 'any', 'input', 'which', 'split', 'loop', 'ordered', 'special'
     def __init__(self, which, entry, loop=False):
         """
         input:
@@ -192,63 +332,95 @@ class _Matcher(object):
         """
         _assert(0 <= which <= YEAR_OFFSET,
             "improper number of cron entries specified")
-        self.input = entry.lower()
-        self.split = self.input.split(',')
-        self.which = which
-        self.allowed = set()
-        self.end = None
-        self.any = '*' in self.split or '?' in self.split
-        self.loop = loop
-
-        for it in self.split:
+        # matchers are immutable once built, so they can be shared between
+        # threads; attributes are set here with _set() instead
+        _set(self, 'loop', loop)
+        input = entry.lower()
+        split = input.split(',')
+        allowed = set()
+        special = []
+        end = None
+
+        for it in split:
             al, en = self._parse_crontab(which, it)
             if al is not None:
-                self.allowed.update(al)
-            self.end = en
-        _assert(self.end is not None,
+                allowed.update(al)
+            elif it not in ('*', '?'):
+                special.append(it)
+            end = en
+        _assert(end is not None,
             "improper item specification: %r", entry.lower()
         )
-        self.allowed = frozenset(self.allowed)
+        _set(self, 'input', input)
+        _set(self, 'split', tuple(split))
+        _set(self, 'which', which)
+        _set(self, 'allowed', frozenset(allowed))
+        _set(self, 'end', end)
+        _set(self, 'any', '*' in split or '?' in split)
+        # sorted values for the bisect-based searches in the *_ts() methods
+        if self.any:
+            start, end = _ranges[which]
+            _set(self, 'ordered', tuple(xrange(start, end+1)))
+        else:
+            _set(self, 'ordered', tuple(sorted(allowed)))
+        # L, Lx, Zx, W, and # items depend on where the day falls in its
+        # month, so we precompute the days they match for every month shape:
+        # indexed by (weekday of the 1st) * 4 + (days in month - 28)
+        if special:
+            _set(self, 'special', tuple(
+                frozenset(d for it in special for d in _special_days(it, first, eom))
+                for first in xrange(7) for eom in xrange(28, 32)))
+        else:
+            _set(self, 'special', None)
+
+    __setattr__ = _immutable
+
+    def __getstate__(self):
+        # everything else is derived from these, so isn't worth pickling
+        return {'which': self.which, 'input': self.input, 'loop': self.loop}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = state[1]
+        # older pickles have every slot, only these are needed
+        self.__init__(state['which'], state['input'], state['loop'])
 
     def __call__(self, v, dt):
-        for i, x in enumerate(self.split):
-            if x == 'l':
-                if v == _end_of_month(dt).day:
-                    return True
-
-            elif x.startswith('l'):
-                # We have to do this in here, otherwise we can end up, for
-                # example, accepting *any* Friday instead of the *last* Friday.
-                if dt.month == (dt + WEEK).month:
-                    continue
-
-                x = x[1:]
-                if x.isdigit():
-                    x = int(x, 10) if x != '7' else 0
-                    if v == x:
-                        return True
-                    continue
-
-                start, end = (int(i, 10) for i in x.partition('-')[::2])
-                allowed = set(range(start, end+1))
-                if 7 in allowed:
-                    allowed.add(0)
-                if v in allowed:
-                    return True
-
-            elif x.startswith('z'):
-                x = x[1:]
-                eom = _end_of_month(dt).day
-                if x.isdigit():
-                    x = int(x, 10)
-                    return (eom - x) == v
-
-                start, end = (int(i, 10) for i in x.partition('-')[::2])
-                if v in set(eom - i for i in range(start, end+1)):
-                    return True
+        return self.match(v, dt.day, _days_in_month(dt.year, dt.month), dt.isoweekday() % 7)
 
+    def match(self, v, day, eom, wday):
+        '''
+        Like calling the matcher, but with the day of the month, the number of
+        days in the month, and the weekday of the day (Sunday is 0) passed
+        explicitly instead of a datetime.
+        '''
+        special = self.special
+        if special is not None and day in special[(wday - day + 1) % 7 * 4 + eom - 28]:
+            return True
         return self.any or v in self.allowed
 
+    def next_day(self, day, eom, first, step):
+        '''
+        Returns the nearest day of the month after `day` (before, if `step` is
+        -1) that this day of month or day of week matcher matches, in a month
+        with `eom` days whose 1st falls on weekday `first` (Sunday is 0). Returns
+        None if there is no such day in the month.
+        '''
+        special = self.special
+        if special is not None and not self.any and not self.allowed:
+            # only L, Lx, Zx, W, or # items, so only the days in the table
+            for d in sorted(special[first * 4 + eom - 28], reverse=step < 0):
+                if (d - day) * step > 0:
+                    return d
+            return None
+        d = day + step
+        while 1 <= d <= eom:
+            wd = (first + d - 1) % 7
+            if self.match(d if self.which == DAY_OFFSET else wd, d, eom, wd):
+                return d
+            d += step
+        return None
+
     def __lt__(self, other):
         if self.any:
             return self.end < other
@@ -262,10 +434,10 @@ class _Matcher(object):
     def __eq__(self, other):
         if self.any:
             return other.any
-        return self.allowed == other.allowed
+        return self.allowed == other.allowed and self.special == other.special
 
     def __hash__(self):
-        return hash((self.any, self.allowed))
+        return hash((self.any, self.allowed, self.special))
 
     def _parse_crontab(self, which, entry):
         '''
@@ -337,6 +509,25 @@ class _Matcher(object):
                     "cannot use '?' in the %r field", _attribute[which])
             return None, _end
 
+        # nearest weekday to the given day of the month, or the last weekday
+        if entry.endswith('w'):
+            _assert(which == DAY_OFFSET,
+                "you can only specify a trailing 'W' in the 'day' field")
+            es = entry[:-1]
+            _assert(es == 'l' or (es.isdigit() and 1 <= int(es, 10) <= 31),
+                "<day>W specifier must include a day number 1..31 or L in the 'day' field, you entered %r", entry)
+            return None, _end
+
+        # for the 3rd 'monday' of the month, for example
+        if '#' in entry:
+            _assert(which == WEEK_OFFSET,
+                "you can only specify '#' in the 'weekday' field")
+            es, _, ee = entry.partition('#')
+            _assert((es in _alternate[WEEK_OFFSET] or (es.isdigit() and 0 <= int(es, 10) <= 7)) and
+                    ee.isdigit() and 1 <= int(ee, 10) <= 5,
+                "<day>#<n> specifier must include a weekday 0..7 and an n 1..5 in the 'weekday' field, you entered %r", entry)
+            return None, _end
+
         # last day of the month
         if entry == 'l':
             _assert(which == DAY_OFFSET,
@@ -403,8 +594,12 @@ class CronTab(object):
                      (turning 55-5,1 -> 0,1,2,3,4,5,55,56,57,58,59 in a "minutes" column)
             `random_seconds` - randomly select starting second for tasks
         """
-        self.rs = random_seconds
-        self.matchers = self._make_matchers(crontab, loop, random_seconds)
+        _set(self, 'rs', random_seconds)
+        _set(self, 'matchers', self._make_matchers(crontab, loop, random_seconds))
+
+    __setattr__ = _immutable
+    __getstate__ = _getstate
+    __setstate__ = _setstate
 
     def __eq__(self, other):
         if not isinstance(other, CronTab):
@@ -413,6 +608,13 @@ class CronTab(object):
         return match_last and ((self.rs and other.rs) or (not self.rs and
             not other.rs and self.matchers[0] == other.matchers[0]))
 
+    def _schedule_key(self):
+        '''
+        Returns a hashable key that is the same for entries that fire at the
+        same times.
+        '''
+        return tuple((m.input, m.loop) for m in self.matchers)
+
     def _make_matchers(self, crontab, loop, random_seconds):
         '''
         This constructs the full matcher struct.
@@ -449,7 +651,10 @@ class CronTab(object):
         executed.
         '''
         if default_utc is WARN_CHANGE and (isinstance(now, _number_types) or (now and not now.tzinfo) or now is None):
-            warnings.warn(WARNING_CHANGE_MESSAGE, FutureWarning, 2)
+            global _warned_change
+            if not _warned_change:
+                _warned_change = True
+                warnings.warn(WARNING_CHANGE_MESSAGE, FutureWarning, 2)
             default_utc = False
 
         now = now or (datetime.utcnow() if default_utc and default_utc is not WARN_CHANGE else datetime.now())
@@ -527,6 +732,289 @@ class CronTab(object):
                 return False
         return True
 
+    def next_ts(self, ts, date_table=False):
+        '''
+        Returns the first time strictly after the UTC epoch timestamp `ts` that
+        this crontab entry can be executed, as integer epoch seconds, or None
+        if there is no such time. Equivalent to
+        `ct.next(ts, delta=False, default_utc=True)`, but without any datetime
+        objects created along the way.
+
+        If `date_table` is true, matching dates are found by bisecting a
+        lazily-built table of the matching days for each year, which is shared
+        with every other entry with the same day, month, and weekday fields.
+        This is faster for entries that match few days, and for repeated calls.
+        '''
+        start = int(ts // 1) + 1
+        return self._search_ts(start, True, date_table)
+
+    def prev_ts(self, ts, date_table=False):
+        '''
+        Returns the last time strictly before the UTC epoch timestamp `ts` that
+        this crontab entry could have been executed, as integer epoch seconds,
+        or None. See `next_ts()` for `date_table`.
+        '''
+        start = -int(-ts // 1) - 1
+        return self._search_ts(start, False, date_table)
+
+    def test_ts(self, ts):
+        '''
+        Tests whether the UTC epoch timestamp `ts` matches this crontab entry.
+        '''
+        m = self.matchers
+        days, sod = divmod(int(ts // 1), 86400)
+        y, mo, d = _civil_from_days(days)
+        eom = _days_in_month(y, mo)
+        wd = _weekday_from_days(days)
+        return (m.second.match(sod % 60, d, eom, wd) and
+            m.minute.match(sod // 60 % 60, d, eom, wd) and
+            m.hour.match(sod // 3600, d, eom, wd) and
+            m.day.match(d, d, eom, wd) and
+            m.month.match(mo, d, eom, wd) and
+            m.weekday.match(wd, d, eom, wd) and
+            m.year.match(y, d, eom, wd))
+
+    def iter_ts(self, start, end, date_table=False):
+        '''
+        Yields each UTC epoch timestamp after `start` and no later than `end`
+        that this crontab entry matches, in order.
+        '''
+        ts = self.next_ts(start, date_table)
+        while ts is not None and ts <= end:
+            yield ts
+            ts = self.next_ts(ts, date_table)
+
+    def count_ts(self, start, end):
+        '''
+        Counts the UTC epoch timestamps after `start` and no later than `end`
+        that this crontab entry matches, without enumerating them. Uses the
+        date tables described in `next_ts()`.
+        '''
+        start = int(start // 1)
+        end = int(end // 1)
+        if end <= start:
+            return 0
+        m = self.matchers
+        per_day = len(m.hour.ordered) * len(m.minute.ordered) * len(m.second.ordered)
+        sday, ssod = divmod(start, 86400)
+        eday, esod = divmod(end, 86400)
+        total = 0
+        years = m.year.ordered
+        first = max(_civil_from_days(sday)[0], years[0])
+        last = min(_civil_from_days(eday)[0], years[-1])
+        for y in xrange(first, last + 1):
+            if not (m.year.any or y in m.year.allowed):
+                continue
+            table = self._date_table(y)
+            lo = bisect_left(table, sday)
+            hi = bisect_right(table, eday)
+            total += (hi - lo) * per_day
+            # take back what is at or before start, and after end
+            if lo < hi and table[lo] == sday:
+                total -= self._count_tod(ssod)
+            if lo < hi and table[hi-1] == eday:
+                total -= per_day - self._count_tod(esod)
+        return total
+
+    def _count_tod(self, sod):
+        '''
+        Counts the matching seconds of the day at or before `sod`.
+        '''
+        m = self.matchers
+        hours, minutes, seconds = m.hour.ordered, m.minute.ordered, m.second.ordered
+        h, mi, s = sod // 3600, sod // 60 % 60, sod % 60
+        count = bisect_left(hours, h) * len(minutes) * len(seconds)
+        if h in m.hour.allowed or m.hour.any:
+            count += bisect_left(minutes, mi) * len(seconds)
+            if mi in m.minute.allowed or m.minute.any:
+                count += bisect_right(seconds, s)
+        return count
+
+    def _date_table(self, y):
+        '''
+        Returns the sorted array of day numbers in year `y` that match the
+        day, month, and weekday fields, building it if necessary.
+        '''
+        m = self.matchers
+        key = (m.day.input, m.month.input, m.weekday.input, m.day.loop, y)
+        with _date_tables_lock:
+            days = _date_tables.pop(key, None)
+            if days is not None:
+                # re-insert as most recently used
+                _date_tables[key] = days
+                return days
+        days = _build_date_table(m, y)
+        with _date_tables_lock:
+            _date_tables[key] = days
+            while len(_date_tables) > _date_tables_maxsize:
+                _date_tables.popitem(last=False)
+        return days
+
+    def _search_ts(self, start, forward, date_table=False):
+        '''
+        Finds the first matching timestamp at or after `start` (at or before,
+        if not `forward`). Works a year at a time, then a month at a time (or
+        bisects the year's date table), then jumps between matching days, and
+        finishes with a bisect over time-of-day values.
+        '''
+        m = self.matchers
+        years = m.year.ordered
+        months = m.month.ordered
+        days, sod = divmod(start, 86400)
+        y, mo, d = _civil_from_days(days)
+        while True:
+            # outside of the supported years counts as not matching
+            if not years[0] <= y <= years[-1] or (y not in m.year.allowed and not m.year.any):
+                if forward:
+                    i = bisect_right(years, y)
+                    if i == len(years):
+                        return None
+                    y, mo, d, sod = years[i], 1, 1, 0
+                else:
+                    i = bisect_left(years, y) - 1
+                    if i < 0:
+                        return None
+                    y, mo, d, sod = years[i], 12, 31, 86399
+
+            if date_table:
+                table = self._date_table(y)
+                today = _days_from_civil(y, mo, d)
+                if forward:
+                    for i in xrange(bisect_left(table, today), len(table)):
+                        tod = self._search_tod(sod if table[i] == today else 0, True)
+                        if tod is not None:
+                            return table[i] * 86400 + tod
+                    y, mo, d, sod = y + 1, 1, 1, 0
+                else:
+                    for i in xrange(bisect_right(table, today) - 1, -1, -1):
+                        tod = self._search_tod(sod if table[i] == today else 86399, False)
+                        if tod is not None:
+                            return table[i] * 86400 + tod
+                    y, mo, d, sod = y - 1, 12, 31, 86399
+                continue
+
+            if mo not in m.month.allowed and not m.month.any:
+                if forward:
+                    i = bisect_right(months, mo)
+                    if i == len(months):
+                        y, mo, d, sod = y + 1, 1, 1, 0
+                        continue
+                    mo, d, sod = months[i], 1, 0
+                else:
+                    i = bisect_left(months, mo) - 1
+                    if i < 0:
+                        y, mo, d, sod = y - 1, 12, 31, 86399
+                        continue
+                    mo, sod = months[i], 86399
+                    d = _days_in_month(y, mo)
+
+            eom = _days_in_month(y, mo)
+            base = _days_from_civil(y, mo, 1)
+            first = _weekday_from_days(base)
+            step = 1 if forward else -1
+            while d is not None:
+                wd = (first + d - 1) % 7
+                if not m.day.match(d, d, eom, wd):
+                    d = m.day.next_day(d, eom, first, step)
+                elif not m.weekday.match(wd, d, eom, wd):
+                    d = m.weekday.next_day(d, eom, first, step)
+                else:
+                    tod = self._search_tod(sod, forward)
+                    if tod is not None:
+                        return (base + d - 1) * 86400 + tod
+                    d += step
+                    if not 1 <= d <= eom:
+                        d = None
+                sod = 0 if forward else 86399
+
+            if forward:
+                mo += 1
+                if mo > 12:
+                    y, mo = y + 1, 1
+                d = 1
+            else:
+                mo -= 1
+                if mo < 1:
+                    y, mo = y - 1, 12
+                d = _days_in_month(y, mo)
+
+    def _search_tod(self, sod, forward):
+        '''
+        Finds the first matching second of the day at or after `sod` (at or
+        before, if not `forward`), or None.
+        '''
+        m = self.matchers
+        hours, minutes, seconds = m.hour.ordered, m.minute.ordered, m.second.ordered
+        h, mi, s = sod // 3600, sod // 60 % 60, sod % 60
+        if forward:
+            i = bisect_left(hours, h)
+            if i < len(hours) and hours[i] == h:
+                j = bisect_left(minutes, mi)
+                if j < len(minutes) and minutes[j] == mi:
+                    k = bisect_left(seconds, s)
+                    if k < len(seconds):
+                        return sod - s + seconds[k]
+                    j += 1
+                if j < len(minutes):
+                    return h * 3600 + minutes[j] * 60 + seconds[0]
+                i += 1
+            if i < len(hours):
+                return hours[i] * 3600 + minutes[0] * 60 + seconds[0]
+            return None
+
+        i = bisect_right(hours, h) - 1
+        if i >= 0 and hours[i] == h:
+            j = bisect_right(minutes, mi) - 1
+            if j >= 0 and minutes[j] == mi:
+                k = bisect_right(seconds, s) - 1
+                if k >= 0:
+                    return sod - s + seconds[k]
+                j -= 1
+            if j >= 0:
+                return h * 3600 + minutes[j] * 60 + seconds[-1]
+            i -= 1
+        if i >= 0:
+            return hours[i] * 3600 + minutes[-1] * 60 + seconds[-1]
+        return None
+
+def next_many(entries, now, max_workers=None, date_table=False, executor=None, chunk_size=None):
+    '''
+    Returns a list of `entry.next_ts(now, date_table)` for each of the
+    `entries`, computed in parallel on a thread pool. CronTab objects are
+    immutable and the *_ts() methods only share the lock-protected date table
+    cache, so on free-threaded Python builds this scales with the number of
+    threads. Needs Python 3, for concurrent.futures.
+
+    inputs:
+        `entries` - sequence of CronTab objects
+        `now` - UTC epoch timestamp
+        `max_workers` - number of threads, defaults to the number of cpus
+        `executor` - an existing concurrent.futures executor to use instead of
+                     creating a pool of `max_workers` threads
+        `chunk_size` - how many entries each task computes, defaults to
+                       splitting the entries into 4 tasks per thread
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    entries = list(entries)
+    def _chunk(chunk):
+        return [entry.next_ts(now, date_table) for entry in chunk]
+
+    workers = max_workers or getattr(os, 'cpu_count', lambda: None)() or 1
+    pool = executor or ThreadPoolExecutor(workers)
+    try:
+        # a few chunks per thread keeps the threads busy without paying for a
+        # future per entry
+        size = chunk_size or max(1, -(-len(entries) // (workers * 4)))
+        chunks = [entries[i:i+size] for i in xrange(0, len(entries), size)]
+        out = []
+        for result in pool.map(_chunk, chunks):
+            out.extend(result)
+        return out
+    finally:
+        if executor is None:
+            pool.shutdown()
+
 def _fix_none(d, _=timedelta(0)):
     if d is None:
         return _
@@ -0,0 +1,161 @@
+
+'''
+_shard.py
+
+Consistent-hash partitioning of crontab entries across scheduler nodes, so
+each node only needs to compute next fire times for the entries it owns.
+
+Copyright 2011-2025 Josiah Carlson
+Released under the GNU LGPL v2.1 and v3
+'''
+
+from bisect import bisect_right
+from hashlib import md5
+
+from ._crontab import CronTab
+
+
+def _hash(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return int(md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    __slots__ = 'replicas', 'members', '_points', '_owners'
+    def __init__(self, members=(), replicas=64):
+        """
+        input:
+            `members` - the names of the nodes on the ring
+            `replicas` - how many points each node gets on the ring; more
+                         points give a more even split of keys between nodes
+        """
+        self.replicas = replicas
+        self.members = frozenset()
+        self._points = []
+        self._owners = []
+        self.set_members(members)
+
+    def set_members(self, members):
+        '''
+        Replaces the nodes on the ring. Keys only move to or from nodes that
+        were added or removed.
+        '''
+        self.members = frozenset(str(m) for m in members)
+        points = sorted(
+            (_hash('%s-%i' % (member, i)), member)
+            for member in self.members
+            for i in range(self.replicas)
+        )
+        self._points = [p for p, _ in points]
+        self._owners = [m for _, m in points]
+
+    def add(self, member):
+        self.set_members(self.members | set([str(member)]))
+
+    def remove(self, member):
+        self.set_members(self.members - set([str(member)]))
+
+    def node_for(self, key):
+        '''
+        Returns the node that owns the given key, or None if the ring is empty.
+        '''
+        if not self._points:
+            return None
+        i = bisect_right(self._points, _hash(str(key)))
+        return self._owners[i % len(self._owners)]
+
+
+class LocalMembership(object):
+    '''
+    In-process membership list, for tests and single-host deployments. Anything
+    with a `members()` method returning node names can be used instead.
+    '''
+    __slots__ = '_members',
+    def __init__(self, members=()):
+        self._members = set(members)
+
+    def join(self, member):
+        self._members.add(member)
+
+    def leave(self, member):
+        self._members.discard(member)
+
+    def members(self):
+        return sorted(self._members)
+
+
+class ShardedScheduler(object):
+    __slots__ = 'node', 'membership', 'ring', 'entries', 'owned'
+    def __init__(self, node, membership, entries=None, replicas=64):
+        """
+        input:
+            `node` - the name of this node in the membership list
+            `membership` - object with a `members()` method returning the
+                           names of all live nodes
+            `entries` - dictionary of {key: crontab}, where crontab is a
+                        CronTab or a crontab string; strings are only parsed
+                        if this node owns the entry
+            `replicas` - see HashRing
+        """
+        self.node = str(node)
+        self.membership = membership
+        self.ring = HashRing(membership.members(), replicas)
+        self.entries = {}
+        self.owned = {}
+        for key, entry in (entries or {}).items():
+            self.add(key, entry)
+
+    def add(self, key, entry):
+        '''
+        Adds or replaces an entry, returning True if this node owns it.
+        '''
+        self.entries[key] = entry
+        self.owned.pop(key, None)
+        if self.ring.node_for(key) != self.node:
+            return False
+        if not isinstance(entry, CronTab):
+            entry = CronTab(entry)
+        self.owned[key] = entry
+        return True
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+        self.owned.pop(key, None)
+
+    def rebalance(self):
+        '''
+        Refreshes the ring from the membership list. Returns a pair of sets:
+        the keys this node has gained, and the keys it has lost.
+        '''
+        members = frozenset(str(m) for m in self.membership.members())
+        if members == self.ring.members:
+            return set(), set()
+        self.ring.set_members(members)
+        gained = set()
+        lost = set()
+        for key, entry in self.entries.items():
+            mine = self.ring.node_for(key) == self.node
+            if mine and key not in self.owned:
+                if not isinstance(entry, CronTab):
+                    entry = CronTab(entry)
+                self.owned[key] = entry
+                gained.add(key)
+            elif not mine and key in self.owned:
+                del self.owned[key]
+                lost.add(key)
+        return gained, lost
+
+    def next_ts(self, now, date_table=False):
+        '''
+        Returns a list of (timestamp, key) pairs, sorted by timestamp, with the
+        next fire time after the UTC epoch timestamp `now` for each entry owned
+        by this node. Entries that will never fire again are left out.
+        '''
+        out = []
+        for key, entry in self.owned.items():
+            ts = entry.next_ts(now, date_table)
+            if ts is not None:
+                out.append((ts, key))
+        out.sort(key=lambda x: x[0])
+        return out
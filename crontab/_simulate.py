@@ -0,0 +1,155 @@
+
+'''
+_simulate.py
+
+Replays the firings of many crontab entries against a virtual clock, jumping
+straight from one fire time to the next instead of ticking.
+
+Copyright 2011-2025 Josiah Carlson
+Released under the GNU LGPL v2.1 and v3
+'''
+
+import heapq
+import time
+
+from ._crontab import CronTab
+
+
+class VirtualClock(object):
+    __slots__ = 'now',
+    def __init__(self, now=0):
+        """
+        input:
+            `now` - the starting UTC epoch timestamp
+        """
+        self.now = now
+
+    def __call__(self):
+        '''
+        Returns the current virtual time, so the clock can stand in for
+        time.time().
+        '''
+        return self.now
+
+    def advance_to(self, ts):
+        if ts > self.now:
+            self.now = ts
+
+
+class Simulator(object):
+    __slots__ = 'clock', 'groups', 'heap', 'pending', 'firings', 'events', 'elapsed', 'start', 'date_table'
+    def __init__(self, entries, start, clock=None, date_table=True):
+        """
+        input:
+            `entries` - dictionary of {key: crontab}, where crontab is a
+                        CronTab or a crontab string
+            `start` - UTC epoch timestamp to start the simulation from; the
+                      first firings are those strictly after this time
+            `clock` - VirtualClock to advance as the simulation runs, one is
+                      created if not provided
+            `date_table` - passed through to CronTab.next_ts()
+        """
+        self.clock = clock or VirtualClock(start)
+        self.clock.advance_to(start)
+        self.start = start
+        self.date_table = date_table
+        self.firings = self.events = 0
+        self.elapsed = 0.0
+
+        # entries with the same schedule only need to be parsed and searched
+        # once
+        index = {}
+        by_text = {}
+        self.groups = []
+        for key, entry in entries.items():
+            i = None if isinstance(entry, CronTab) else by_text.get(entry)
+            if i is None:
+                ct = entry if isinstance(entry, CronTab) else CronTab(entry)
+                gkey = ct._schedule_key()
+                i = index.get(gkey)
+                if i is None:
+                    i = index[gkey] = len(self.groups)
+                    self.groups.append((ct, []))
+                if ct is not entry:
+                    by_text[entry] = i
+            self.groups[i][1].append(key)
+
+        # [timestamp, group index, position] of the group being yielded, so a
+        # caller that stops iterating partway picks up where it left off
+        self.pending = None
+        self.heap = []
+        for i, (entry, _) in enumerate(self.groups):
+            ts = entry.next_ts(start, date_table)
+            if ts is not None:
+                self.heap.append((ts, i))
+        heapq.heapify(self.heap)
+
+    def run(self, until):
+        '''
+        Yields (timestamp, key) for every firing after the previous call (or
+        the start) and no later than the UTC epoch timestamp `until`, in time
+        order, advancing the clock as it goes. Entries that fire at the same
+        time are yielded in the order they were passed in, grouped by schedule.
+        '''
+        heap = self.heap
+        groups = self.groups
+        date_table = self.date_table
+        clock = self.clock
+        t = time.time()
+        try:
+            while True:
+                pending = self.pending
+                if pending is None:
+                    if not heap or heap[0][0] > until:
+                        break
+                    # reschedule the group before yielding any of its keys
+                    ts, i = heap[0]
+                    nts = groups[i][0].next_ts(ts, date_table)
+                    if nts is None:
+                        heapq.heappop(heap)
+                    else:
+                        heapq.heapreplace(heap, (nts, i))
+                    clock.advance_to(ts)
+                    self.events += 1
+                    pending = self.pending = [ts, i, 0]
+
+                ts, i, pos = pending
+                if ts > until:
+                    break
+                keys = groups[i][1]
+                while pos < len(keys):
+                    pos += 1
+                    pending[2] = pos
+                    self.firings += 1
+                    yield ts, keys[pos-1]
+                self.pending = None
+            clock.advance_to(until)
+        finally:
+            self.elapsed += time.time() - t
+
+    def next_ts(self):
+        '''
+        Returns the time of the next firing, or None if nothing will fire.
+        '''
+        pending = self.pending
+        if pending is not None and pending[2] < len(self.groups[pending[1]][1]):
+            return pending[0]
+        return self.heap[0][0] if self.heap else None
+
+    def metrics(self):
+        '''
+        Returns a dictionary of throughput information for the simulation so
+        far. `elapsed` is wall-clock seconds spent running, and includes time
+        spent by the caller consuming the firings.
+        '''
+        elapsed = self.elapsed or 1e-9
+        return {
+            'entries': sum(len(keys) for _, keys in self.groups),
+            'schedules': len(self.groups),
+            'firings': self.firings,
+            'events': self.events,
+            'simulated_seconds': self.clock.now - self.start,
+            'elapsed': self.elapsed,
+            'firings_per_second': self.firings / elapsed,
+            'speedup': (self.clock.now - self.start) / elapsed,
+        }
@@ -0,0 +1,186 @@
+
+'''
+_store.py
+
+Durable storage of the last time each entry fired, and recovery of the runs
+that were missed while the scheduler was down.
+
+Copyright 2011-2025 Josiah Carlson
+Released under the GNU LGPL v2.1 and v3
+'''
+
+import json
+import os
+import sqlite3
+
+from ._crontab import CronTab, _assert, _string_types
+
+# what to do about runs missed while the scheduler was down
+MISSED_ALL = 'all'      # run every missed time
+MISSED_ONCE = 'once'    # run once, for the most recent missed time
+MISSED_SKIP = 'skip'    # don't run, just report how many were missed
+_policies = (MISSED_ALL, MISSED_ONCE, MISSED_SKIP)
+
+
+class _FireStore(object):
+    def __init__(self, batch_size=100):
+        """
+        input:
+            `batch_size` - how many recorded fire times to buffer before they
+                           are written out; call .flush() to write sooner
+        """
+        self.batch_size = batch_size
+        self.last = self._load()
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, key, ts):
+        '''
+        Records that the entry `key` fired at UTC epoch timestamp `ts`. Keys
+        must be strings, as they are stored as text.
+        '''
+        _assert(isinstance(key, _string_types),
+            "fire store keys must be strings, you provided %r", key)
+        self.last[key] = ts
+        self._pending[key] = ts
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._write(sorted(self._pending.items()))
+            self._pending = {}
+
+    def close(self):
+        self.flush()
+        self._close()
+
+    def missed(self, entries, now, policy=MISSED_ONCE, date_table=False):
+        '''
+        Works out what was missed between the recorded last fire time of each
+        entry and the UTC epoch timestamp `now`.
+
+        input:
+            `entries` - dictionary of {key: CronTab}; keys without a recorded
+                        fire time are skipped
+            `policy` - one of MISSED_ALL, MISSED_ONCE, or MISSED_SKIP
+        returns:
+            {key: (missed_count, [timestamps to run])} for the entries that
+            missed at least one run
+        '''
+        _assert(policy in _policies,
+            "missed run policy must be one of %r, you provided %r", _policies, policy)
+        out = {}
+        for key, entry in entries.items():
+            last = self.last.get(key)
+            if last is None:
+                continue
+            if not isinstance(entry, CronTab):
+                entry = CronTab(entry)
+            if policy == MISSED_ALL:
+                run = list(entry.iter_ts(last, now, date_table))
+                count = len(run)
+            else:
+                count = entry.count_ts(last, now)
+                run = []
+                if count and policy == MISSED_ONCE:
+                    run.append(entry.prev_ts(int(now // 1) + 1, date_table))
+            if count:
+                out[key] = (count, run)
+        return out
+
+
+class SQLiteFireStore(_FireStore):
+    '''
+    Keeps the last fire time of each entry in a SQLite table. Entry keys must
+    be strings.
+    '''
+    def __init__(self, path, batch_size=100, table='crontab_last_fire'):
+        """
+        input:
+            `path` - path to the SQLite database, created if necessary
+            `table` - the name of the table to use
+        """
+        _assert(table.replace('_', '').isalnum(),
+            "invalid table name: %r", table)
+        self.table = table
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, ts INTEGER NOT NULL)' % table)
+        self.conn.commit()
+        _FireStore.__init__(self, batch_size)
+
+    def _load(self):
+        return dict(self.conn.execute('SELECT key, ts FROM %s' % self.table))
+
+    def _write(self, items):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO %s (key, ts) VALUES (?, ?)' % self.table, items)
+
+    def _close(self):
+        self.conn.close()
+
+
+class LogFireStore(_FireStore):
+    '''
+    Keeps the last fire time of each entry in an append-only log of JSON
+    lines. Entry keys must be strings.
+    '''
+    def __init__(self, path, batch_size=100, fsync=True):
+        """
+        input:
+            `path` - path to the append-only log, created if necessary
+            `fsync` - whether to fsync the log after each batch
+        """
+        self.path = path
+        self.fsync = fsync
+        self._torn = False
+        _FireStore.__init__(self, batch_size)
+        self.log = open(path, 'a')
+        if self._torn:
+            # don't glue the next record onto a partially-written one
+            self.log.write('\n')
+
+    def _load(self):
+        last = {}
+        if not os.path.exists(self.path):
+            return last
+        with open(self.path) as f:
+            for line in f:
+                self._torn = not line.endswith('\n')
+                try:
+                    key, ts = json.loads(line)
+                except ValueError:
+                    # partial last line from a crash mid-write
+                    continue
+                last[key] = ts
+        return last
+
+    def _write(self, items):
+        self.log.write(''.join(json.dumps([k, v]) + '\n' for k, v in items))
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+
+    def _close(self):
+        self.log.close()
+
+    def compact(self):
+        '''
+        Rewrites the log with only the latest fire time for each entry.
+        '''
+        self.flush()
+        self.log.close()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(''.join(json.dumps([k, v]) + '\n' for k, v in sorted(self.last.items())))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.log = open(self.path, 'a')
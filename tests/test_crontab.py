@@ -1,12 +1,29 @@
 
 from collections import namedtuple
 import datetime
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
 import unittest
+import warnings
 
 import pytz
 import dateutil.tz
 
-from crontab import CronTab
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+import crontab._crontab
+from crontab import (CronTab, next_many, clear_date_tables,
+    set_date_tables_maxsize, HashRing, LocalMembership, ShardedScheduler,
+    LogFireStore, SQLiteFireStore, MISSED_ALL, MISSED_ONCE, MISSED_SKIP,
+    Simulator, VirtualClock, ResultCache)
 
 Results = namedtuple('Results', 'crontab delay max_delay now future')
 
@@ -166,6 +183,13 @@ class TestCrontab(unittest.TestCase):
         self.assertRaises(ValueError, lambda: CronTab('*,50-59/12 * * * *'))
         self.assertRaises(ValueError, lambda: CronTab('* * * DEC/7 * *'))
         self.assertRaises(ValueError, lambda: CronTab('* * * * MON/7 *'))
+        self.assertRaises(ValueError, lambda: CronTab('* * * * 15W'))
+        self.assertRaises(ValueError, lambda: CronTab('* * 32W * *'))
+        self.assertRaises(ValueError, lambda: CronTab('* * 0W * *'))
+        self.assertRaises(ValueError, lambda: CronTab('* * 1#2 * *'))
+        self.assertRaises(ValueError, lambda: CronTab('* * * * 1#6'))
+        self.assertRaises(ValueError, lambda: CronTab('* * * * 8#1'))
+        self.assertRaises(ValueError, lambda: CronTab('* * * * foo#1'))
 
     def test_previous(self):
         schedule = CronTab('0 * * * *')
@@ -241,6 +265,406 @@ class TestCrontab(unittest.TestCase):
         self.assertEqual(last.day - 7, (a_day + datetime.timedelta(seconds=d.next(a_day))).day)
         self.assertEqual(last.day - 7, (a_day + datetime.timedelta(seconds=e.next(a_day))).day)
 
+    def test_epoch_ts(self):
+        entries = ['*/5 * * * * * *', '0 0 1 * *', '5-51/15 * * * *',
+            '0 0 L 2 ?', '0 0 ? 7 L3-5', '59 23 L 12 *', '* * z1 * *',
+            '0 12 * * sat-sun', '* * 13 * Fri *', '0 0 29 2 * 2012-2015',
+            '*/7 3,5 */3 jan/2 mon-fri', '0 0 * 7 fri 2011']
+        start = datetime.datetime(2011, 7, 15, 3, 4, 5)
+        for entry in entries:
+            ct = CronTab(entry)
+            now = start
+            for i in range(25):
+                ts = (now - datetime.datetime(1970, 1, 1)).total_seconds()
+                n = ct.next(now, delta=False, default_utc=True)
+                self.assertEqual(ct.next_ts(ts), n if n is None else int(n), (entry, now))
+                p = ct.previous(now, delta=False, default_utc=True)
+                self.assertEqual(ct.prev_ts(ts), p if p is None else int(p), (entry, now))
+                self.assertEqual(ct.test_ts(ts), ct.test(now), (entry, now))
+                now += datetime.timedelta(days=13, seconds=3607)
+
+        ct = CronTab('0 * * * *')
+        self.assertEqual(ct.next_ts(3600), 7200)
+        self.assertEqual(ct.next_ts(3599.5), 3600)
+        self.assertEqual(ct.prev_ts(3600), 0)
+        self.assertEqual(ct.prev_ts(3600.5), 3600)
+        self.assertTrue(ct.test_ts(7200))
+        self.assertFalse(ct.test_ts(7201))
+        self.assertIsNone(CronTab('0 0 * * * 2099').next_ts(4102444800))
+        self.assertIsNone(CronTab('0 0 * * * 1970').prev_ts(0))
+        # crosses a year boundary backwards
+        self.assertEqual(CronTab('30 1 * * * 2018').prev_ts(1556078584), 1546219800)
+        self.assertEqual(CronTab('30 1 * * * 2018').previous(1556078584,
+            delta=False, default_utc=True), 1546219800)
+
+    def test_date_table(self):
+        entries = ['*/5 * * * * * *', '0 0 29 2 *', '0 0 ? 7 L3-5',
+            '59 23 L 12 *', '0 8 z0-3 * *', '* * 13 * Fri *',
+            '0 0 29 2 * 2012-2015', '*/7 3,5 */3 jan/2 mon-fri', '0 0 ? * L5',
+            '30 1 * * * 2018', '0 0 * 7 fri 2011']
+        for entry in entries:
+            ct = CronTab(entry)
+            ts = -86400 * 30
+            while ts < 4200000000:
+                for f in (ct.next_ts, ct.prev_ts):
+                    self.assertEqual(f(ts), f(ts, date_table=True), (entry, ts, f))
+                ts += 86400 * 157 + 3607
+        # last fridays of 2016 are shared with a different entry
+        a = CronTab('0 0 ? * L5')
+        b = CronTab('30 12 ? * L5')
+        a.next_ts(1451606400, date_table=True)
+        self.assertIs(a._date_table(2016), b._date_table(2016))
+        self.assertEqual(len(a._date_table(2016)), 12)
+
+        # the cache is bounded, least recently used tables go first
+        tables = crontab._crontab._date_tables
+        try:
+            set_date_tables_maxsize(3)
+            self.assertTrue(len(tables) <= 3)
+            for y in (2016, 2017, 2018):
+                a._date_table(y)
+            a._date_table(2016)
+            a._date_table(2019)
+            self.assertEqual([k[-1] for k in tables], [2018, 2016, 2019])
+            self.assertEqual(a.next_ts(1451606400, date_table=True), a.next_ts(1451606400))
+            clear_date_tables()
+            self.assertEqual(len(tables), 0)
+        finally:
+            set_date_tables_maxsize(4096)
+
+    def test_sharding(self):
+        entries = dict(('job-%i' % i, '%i * * * *' % (i % 60)) for i in range(600))
+        membership = LocalMembership(['a', 'b', 'c'])
+        nodes = dict((n, ShardedScheduler(n, membership, entries)) for n in 'abc')
+        owned = [set(s.owned) for s in nodes.values()]
+        self.assertEqual(set.union(*owned), set(entries))
+        self.assertEqual(sum(map(len, owned)), len(entries))
+        for o in owned:
+            self.assertTrue(100 < len(o) < 300, len(o))
+
+        now = 1500000000
+        fires = sorted(f for s in nodes.values() for f in s.next_ts(now))
+        expect = sorted((CronTab(e).next_ts(now), k) for k, e in entries.items())
+        self.assertEqual(fires, expect)
+
+        # a new node only takes entries, and takes roughly its share
+        membership.join('d')
+        nodes['d'] = ShardedScheduler('d', membership, entries)
+        moved = set()
+        for n in 'abc':
+            gained, lost = nodes[n].rebalance()
+            self.assertEqual(gained, set())
+            moved |= lost
+        self.assertEqual(moved, set(nodes['d'].owned))
+        self.assertTrue(75 < len(moved) < 225, len(moved))
+
+        # and when it leaves, its entries go back where they were
+        membership.leave('d')
+        gained = set()
+        for n in 'abc':
+            g, lost = nodes[n].rebalance()
+            self.assertEqual(lost, set())
+            gained |= g
+        self.assertEqual(gained, moved)
+        self.assertEqual(HashRing().node_for('x'), None)
+
+    def test_count_ts(self):
+        for entry in ['*/20 */15 * * * * *', '0 0 29 2 *', '0 0 ? * L5',
+                '*/7 3,5 */3 jan/2 mon-fri', '15,45 */2 * * * * 2015-2020']:
+            ct = CronTab(entry)
+            start = 1420070400
+            for length in (10, 7200, 86400 * 3, 86400 * 40):
+                self.assertEqual(ct.count_ts(start, start + length),
+                    len(list(ct.iter_ts(start, start + length))), (entry, length))
+                start += 86400 * 31 + 1234
+        ct = CronTab('0 * * * *')
+        self.assertEqual(list(ct.iter_ts(0, 7200)), [3600, 7200])
+        self.assertEqual(ct.count_ts(0, 7200), 2)
+        self.assertEqual(ct.count_ts(3600, 3600), 0)
+        # 2000, 2004, 2008
+        self.assertEqual(CronTab('0 0 29 2 *').count_ts(946684800, 1262304000), 3)
+        # only the supported years, 1970-2099, are counted or iterated
+        ct = CronTab('0 0 * * *')
+        for start, end in ((4102444800 - 2 * 86400, 4102444800 + 8 * 86400),
+                (-2 * 86400, 8 * 86400)):
+            self.assertEqual(ct.count_ts(start, end), len(list(ct.iter_ts(start, end))))
+        self.assertEqual(ct.count_ts(4102444800 - 2 * 86400, 4102444800 + 8 * 86400), 1)
+        self.assertEqual(ct.count_ts(-2 * 86400, 8 * 86400), 9)
+        self.assertEqual(ct.next_ts(-2 * 86400), 0)
+
+    def test_fire_stores(self):
+        path = tempfile.mkdtemp()
+        try:
+            for store in (SQLiteFireStore, LogFireStore):
+                fname = os.path.join(path, store.__name__)
+                entries = {'minutely': CronTab('* * * * *'), 'hourly': '0 * * * *',
+                    'yearly': '@yearly', 'new': '* * * * *'}
+                with store(fname, batch_size=2) as s:
+                    s.record('minutely', 3600)
+                    s.record('hourly', 3600)
+                    s.record('yearly', 0)
+
+                # the last record is flushed on close
+                s = store(fname)
+                self.assertEqual(s.last, {'minutely': 3600, 'hourly': 3600, 'yearly': 0})
+                now = 3 * 3600 + 30
+                self.assertEqual(s.missed(entries, now, MISSED_ALL), {
+                    'minutely': (120, list(range(3660, 3 * 3600 + 1, 60))),
+                    'hourly': (2, [7200, 10800]),
+                })
+                self.assertEqual(s.missed(entries, now, MISSED_ONCE), {
+                    'minutely': (120, [10800]),
+                    'hourly': (2, [10800]),
+                })
+                self.assertEqual(s.missed(entries, now, MISSED_SKIP), {
+                    'minutely': (120, []),
+                    'hourly': (2, []),
+                })
+                self.assertRaises(ValueError, lambda: s.missed(entries, now, 'some'))
+                # keys are stored as text, other types wouldn't survive a reload
+                self.assertRaises(ValueError, lambda: s.record(42, 10800))
+                self.assertRaises(ValueError, lambda: s.record(('a', 1), 10800))
+                s.record('hourly', 10800)
+                s.close()
+                self.assertEqual(store(fname).last['hourly'], 10800)
+
+            # a partially-written final record is ignored, and isn't glued to
+            # the next one
+            fname = os.path.join(path, 'torn')
+            with open(fname, 'w') as f:
+                f.write('["a", 1]\n["b", 2')
+            with LogFireStore(fname, batch_size=1) as s:
+                self.assertEqual(s.last, {'a': 1})
+                s.record('c', 3)
+                s.compact()
+                s.record('d', 4)
+            self.assertEqual(LogFireStore(fname).last, {'a': 1, 'c': 3, 'd': 4})
+        finally:
+            shutil.rmtree(path)
+
+    def test_immutable(self):
+        ct = CronTab('*/5 1 L * *', random_seconds=True)
+        self.assertRaises(AttributeError, lambda: setattr(ct, 'rs', False))
+        self.assertRaises(AttributeError, lambda: setattr(ct.matchers.day, 'any', True))
+        copy = pickle.loads(pickle.dumps(ct))
+        self.assertEqual(copy, ct)
+        self.assertEqual(copy.matchers.second.input, ct.matchers.second.input)
+        self.assertEqual(copy.next_ts(1500000000), ct.next_ts(1500000000))
+        # random_seconds still follows random.seed()
+        seconds = []
+        for i in range(2):
+            random.seed(42)
+            seconds.append([CronTab('* * * * *', random_seconds=True).matchers.second.input
+                for j in range(10)])
+        self.assertEqual(seconds[0], seconds[1])
+        # only what's needed to re-parse the matchers is pickled
+        self.assertEqual(sorted(ct.matchers.day.__getstate__()), ['input', 'loop', 'which'])
+        # pickles with every slot still load
+        day = object.__new__(type(ct.matchers.day))
+        day.__setstate__(dict((name, getattr(ct.matchers.day, name)) for name in day.__slots__))
+        self.assertEqual(day, ct.matchers.day)
+        self.assertEqual(day.special, ct.matchers.day.special)
+
+    @unittest.skipIf(ThreadPoolExecutor is None, "needs concurrent.futures")
+    def test_next_many(self):
+        entries = [CronTab('%i %i * * *' % (i % 60, i % 24)) for i in range(1000)]
+        now = 1500000000
+        expect = [ct.next_ts(now) for ct in entries]
+        self.assertEqual(next_many(entries, now, 4), expect)
+        self.assertEqual(next_many(entries, now, 4, date_table=True), expect)
+        self.assertEqual(next_many([], now), [])
+        with ThreadPoolExecutor(2) as pool:
+            self.assertEqual(next_many(entries, now, executor=pool, chunk_size=7), expect)
+            self.assertEqual(next_many(entries, now, executor=pool), expect)
+
+    def test_warn_once(self):
+        warned = crontab._crontab._warned_change
+        crontab._crontab._warned_change = False
+        try:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                ct = CronTab('0 * * * *')
+                ct.next(datetime.datetime(2020, 1, 1))
+                ct.previous(datetime.datetime(2020, 1, 1))
+                ct.next(datetime.datetime(2020, 1, 1), default_utc=True)
+            self.assertEqual([x.category for x in w], [FutureWarning])
+        finally:
+            crontab._crontab._warned_change = warned
+
+    @unittest.skipIf(getattr(sys, '_is_gil_enabled', lambda: True)() or
+        (os.cpu_count() or 1) < 4, "needs a free-threaded build with 4+ cpus")
+    def test_next_many_scaling(self):
+        entries = [CronTab('0 0 ? * L%i' % (i % 7)) for i in range(20000)]
+        def timed(workers):
+            t = time.time()
+            next_many(entries, 1500000000, workers)
+            return time.time() - t
+        timed(4)
+        one = min(timed(1) for i in range(3))
+        four = min(timed(4) for i in range(3))
+        self.assertTrue(one / four > 2.5, (one, four))
+
+    def test_simulator(self):
+        entries = {'a': '*/15 * * * *', 'b': '0 * * * *', 'c': '*/15 * * * *',
+            'd': '0 0 ? * L5', 'e': '0 0 1 1 * 2011', 'f': CronTab('30 12 * * mon-fri')}
+        start = 1420070400  # 2015-01-01
+        end = start + 86400 * 30
+        compiled = dict((k, e if isinstance(e, CronTab) else CronTab(e))
+            for k, e in entries.items())
+        expect = sorted((ts, key) for key, e in compiled.items()
+            for ts in e.iter_ts(start, end))
+
+        clock = VirtualClock()
+        sim = Simulator(entries, start, clock)
+        self.assertEqual(clock(), start)
+        self.assertEqual(sim.next_ts(), start + 900)
+        got = []
+        for ts, key in sim.run(start + 86400 * 10):
+            self.assertEqual(clock(), ts)
+            got.append((ts, key))
+        self.assertEqual(clock(), start + 86400 * 10)
+        got.extend(sim.run(end))
+        self.assertEqual(sorted(got), expect)
+        self.assertEqual([ts for ts, _ in got], sorted(ts for ts, _ in got))
+
+        metrics = sim.metrics()
+        self.assertEqual(metrics['entries'], 6)
+        self.assertEqual(metrics['schedules'], 5)
+        self.assertEqual(metrics['firings'], len(expect))
+        self.assertEqual(metrics['simulated_seconds'], end - start)
+
+        # stopping partway through a group of firings and resuming neither
+        # repeats nor drops any
+        sim = Simulator({'a': '0 * * * *', 'b': '0 * * * *', 'c': '30 * * * *'}, 0)
+        got = []
+        for item in sim.run(7200):
+            got.append(item)
+            break
+        self.assertEqual(got, [(1800, 'c')])
+        self.assertEqual(sim.next_ts(), 3600)
+        for item in sim.run(7200):
+            got.append(item)
+            break
+        # halfway through the 3600 group
+        self.assertEqual(sim.next_ts(), 3600)
+        self.assertEqual(sim.metrics()['firings'], 2)
+        got.extend(sim.run(7200))
+        self.assertEqual(sorted(got), sorted([(3600, 'a'), (3600, 'b'), (1800, 'c'),
+            (5400, 'c'), (7200, 'a'), (7200, 'b')]))
+        self.assertEqual(len(got), sim.metrics()['firings'])
+        self.assertEqual(sim.next_ts(), 9000)
+
+        # entries that will never fire again drop out
+        sim = Simulator({'x': '0 0 1 1 * 2016'}, start)
+        self.assertEqual(list(sim.run(start + 86400 * 800)), [(1451606400, 'x')])
+        self.assertEqual(sim.next_ts(), None)
+
+    def test_result_cache(self):
+        cache = ResultCache(maxsize=2)
+        hourly = [CronTab('0 * * * *') for i in range(10)]
+        for ct in hourly:
+            self.assertEqual(cache.next_ts(ct, 1800), 3600)
+            self.assertEqual(cache.prev_ts(ct, 1800), 0)
+        self.assertEqual((cache.hits, cache.misses), (18, 2))
+        # anything up to the result is answered from the cache
+        self.assertEqual(cache.next_ts(hourly[0], 3599.5), 3600)
+        self.assertEqual(cache.prev_ts(hourly[0], 0.5), 0)
+        self.assertEqual((cache.hits, cache.misses), (20, 2))
+        self.assertEqual(cache.next_ts(hourly[0], 3600), 7200)
+        self.assertEqual(cache.prev_ts(hourly[0], 3600), 0)
+        self.assertEqual((cache.hits, cache.misses), (20, 4))
+
+        # least recently used schedules are dropped
+        cache.next_ts(CronTab('0 0 * * *'), 1800)
+        cache.prev_ts(hourly[0], 1800)
+        self.assertEqual((cache.hits, cache.misses), (21, 5))
+        cache.next_ts(hourly[0], 1800)
+        self.assertEqual((cache.hits, cache.misses), (21, 6))
+
+        # and results match the uncached calls
+        cache.clear()
+        for entry in ['*/20 */15 * * * * *', '0 0 ? * L5', '0 0 1 1 * 2011']:
+            ct = CronTab(entry)
+            for ts in range(1293840000, 1293840000 + 86400 * 400, 86400 * 3 + 1337):
+                self.assertEqual(cache.next_ts(ct, ts), ct.next_ts(ts), (entry, ts))
+                self.assertEqual(cache.prev_ts(ct, ts), ct.prev_ts(ts), (entry, ts))
+                self.assertEqual(cache.next_ts(ct, ts + .5), ct.next_ts(ts + .5), (entry, ts))
+                self.assertEqual(cache.prev_ts(ct, ts + .5), ct.prev_ts(ts + .5), (entry, ts))
+        self.assertTrue(cache.hits > 0)
+
+    def test_quartz_specifiers(self):
+        def nearest_weekday(year, month, day):
+            last = (datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)).day
+            if day > last:
+                return None
+            dt = datetime.date(year, month, day)
+            if dt.isoweekday() == 6:
+                dt += datetime.timedelta(days=-1 if day > 1 else 2)
+            elif dt.isoweekday() == 7:
+                dt += datetime.timedelta(days=1 if day < last else -2)
+            return dt.day
+
+        def nth_weekday(year, month, weekday, n):
+            days = [d for d in range(1, 32) if d <= 28 or
+                datetime.date(year, month, 28) + datetime.timedelta(days=d - 28) < datetime.date(year + month // 12, month % 12 + 1, 1)]
+            days = [d for d in days if datetime.date(year, month, d).isoweekday() % 7 == weekday]
+            return days[n - 1] if n <= len(days) else None
+
+        cases = [
+            ('0 0 15W * ?', lambda y, m: nearest_weekday(y, m, 15)),
+            ('0 0 1W * ?', lambda y, m: nearest_weekday(y, m, 1)),
+            ('0 0 31W * ?', lambda y, m: nearest_weekday(y, m, 31)),
+            ('0 0 LW * ?', lambda y, m: max(nearest_weekday(y, m, d) or 0 for d in range(28, 32))),
+            ('0 0 ? * 1#3', lambda y, m: nth_weekday(y, m, 1, 3)),
+            ('0 0 ? * mon#3', lambda y, m: nth_weekday(y, m, 1, 3)),
+            ('0 0 ? * 7#1', lambda y, m: nth_weekday(y, m, 0, 1)),
+            ('0 0 ? * 5#5', lambda y, m: nth_weekday(y, m, 5, 5)),
+        ]
+        for entry, expect in cases:
+            ct = CronTab(entry)
+            now = datetime.datetime(2020, 12, 31, 12)
+            for year in (2021, 2022, 2023, 2024):
+                for month in range(1, 13):
+                    day = expect(year, month)
+                    if day is None:
+                        continue
+                    want = datetime.datetime(year, month, day)
+                    self.assertEqual(ct.next(now, default_utc=True, return_datetime=True), want, (entry, now))
+                    ts = (now - datetime.datetime(1970, 1, 1)).total_seconds()
+                    want_ts = (want - datetime.datetime(1970, 1, 1)).total_seconds()
+                    self.assertEqual(ct.next_ts(ts), want_ts, (entry, now))
+                    self.assertEqual(ct.next_ts(ts, date_table=True), want_ts, (entry, now))
+                    self.assertEqual(ct.prev_ts(want_ts + 1), want_ts, (entry, now))
+                    self.assertEqual(ct.previous(want + datetime.timedelta(seconds=1), default_utc=True,
+                        return_datetime=True), want, (entry, now))
+                    self.assertTrue(ct.test(want))
+                    now = want
+
+        # Saturday the 1st moves forward to Monday, Sunday the 31st moves back
+        self.assertEqual(CronTab('0 0 1W 1 ? 2022').next(datetime.datetime(2021, 12, 1),
+            default_utc=True, return_datetime=True), datetime.datetime(2022, 1, 3))
+        self.assertEqual(CronTab('0 0 31W 10 ? 2021').next(datetime.datetime(2021, 10, 1),
+            default_utc=True, return_datetime=True), datetime.datetime(2021, 10, 29))
+        # entries that differ only in their L, Lx, Zx, W, or # items differ
+        for a, b in (('0 9 15W * ?', '0 9 1W * ?'), ('0 9 ? * 1#3', '0 9 ? * 2#1'),
+                ('0 9 L * ?', '0 9 Z1 * ?'), ('0 9 ? * L5', '0 9 ? * L4')):
+            self.assertNotEqual(CronTab(a), CronTab(b))
+            self.assertNotEqual(hash(CronTab(a).matchers), hash(CronTab(b).matchers))
+        self.assertEqual(CronTab('0 9 ? * mon#3'), CronTab('0 9 ? * 1#3'))
+        self.assertEqual(hash(CronTab('0 9 ? * mon#3').matchers), hash(CronTab('0 9 ? * 1#3').matchers))
+
+        # combined with other items
+        ct = CronTab('0 0 ? 3 1#1,L5')
+        self.assertEqual(list(ct.iter_ts(1614556799, 1617235200)), [1614556800, 1616716800])
+        ct = CronTab('0 0 ? * mon,fri#2')
+        self.assertEqual(ct.next(datetime.datetime(2021, 3, 9), default_utc=True,
+            return_datetime=True), datetime.datetime(2021, 3, 12))
+        self.assertEqual(ct.previous(datetime.datetime(2021, 3, 12), default_utc=True,
+            return_datetime=True), datetime.datetime(2021, 3, 8))
+        # going back from the 1st of a month lands on the last day of the one before
+        self.assertEqual(CronTab('54 16 L * ?').previous(datetime.datetime(1991, 2, 1, 4, 42, 49),
+            default_utc=True, return_datetime=True), datetime.datetime(1991, 1, 31, 16, 54))
+
 
 if __name__ == '__main__':
     unittest.main()